@@ -12,19 +12,23 @@ from __future__ import annotations
 
 import os
 import asyncio
-import itertools
+import functools
+import hashlib
+import json
+import logging
+import re
+import time
 from typing import Optional
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from dotenv import load_dotenv
 
 from music import PlayerPool, Track
 
-# --- Load .env and token ---
-load_dotenv()
-TOKEN = os.getenv("DISCORD_TOKEN")
+# --- Logging (line-buffered stdout instead of raw print syscalls) ---
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("an29bot")
 
 # --- Intents ---
 INTENTS = discord.Intents.default()
@@ -36,51 +40,107 @@ bot = commands.Bot(command_prefix="!", intents=INTENTS)
 tree = bot.tree
 players = PlayerPool()
 
+# --- Static /help embed, built once (thumbnail attached in on_ready) ---
+HELP_EMBED_BASE = discord.Embed(
+    title="🤖 An29 BOT – Hjelp",
+    description="Her er en oversikt over kommandoene:",
+    color=discord.Color.blurple()
+)
+HELP_EMBED_BASE.add_field(name="▶️ /play <søk eller lenke>", value="Spill en sang fra YouTube.", inline=False)
+HELP_EMBED_BASE.add_field(name="📜 /queue", value="Se hva som spilles nå og resten av køen.", inline=False)
+HELP_EMBED_BASE.add_field(name="⏭️ /skip", value="Hopp over sangen.", inline=False)
+HELP_EMBED_BASE.add_field(name="⏹️ /stop", value="Stopp musikken og koble fra voice.", inline=False)
+HELP_EMBED_BASE.add_field(name="⏸️ /pause", value="Pause avspillingen.", inline=False)
+HELP_EMBED_BASE.add_field(name="▶️ /resume", value="Fortsett etter pause.", inline=False)
+HELP_EMBED_BASE.add_field(name="🔊 /volume <0.0–1.5>", value="Juster volumet (gjelder fra neste sang).", inline=False)
+HELP_EMBED_BASE.add_field(name="🔗 /join", value="Koble boten til voicechannel.", inline=False)
+HELP_EMBED_BASE.add_field(name="🏓 /ping", value="Test responstid (Pong!).", inline=False)
+HELP_EMBED_BASE.add_field(name="ℹ️ /help", value="Viser denne oversikten.", inline=False)
+HELP_EMBED_BASE.set_footer(text="@anthonyleinebo – meld features/bugs 😎")
+
 
 # -------------------------- Helpers --------------------------
-def fmt_duration(seconds: Optional[int]) -> str:
-    """Format a duration in seconds to h:mm:ss or m:ss. Returns 'live' on None/0."""
-    if not seconds:
-        return "live"
+def defer_first(*, ephemeral: bool = False, thinking: bool = False):
+    """
+    Decorator: defer the interaction before the handler body runs.
+
+    Heavy commands (voice connect, yt-dlp lookups) can blow Discord's 3s
+    initial-response deadline; deferring first extends it to 15 minutes.
+    Wrapped handlers must reply via `interaction.followup`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            await interaction.response.defer(ephemeral=ephemeral, thinking=thinking)
+            return await func(interaction, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=4096)
+def fmt_duration(seconds: int) -> str:
+    """Format a duration in seconds to h:mm:ss or m:ss. Durations repeat a lot
+    across tracks, so results are memoized; callers handle the None/0 'live' case."""
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
     return f"{h:d}:{m:02d}:{s:02d}" if h else f"{m:d}:{s:02d}"
 
 
-async def get_user_voice_channel(interaction: discord.Interaction) -> Optional[discord.VoiceChannel]:
-    """Return the user's current voice channel in this guild, or None."""
-    assert interaction.guild
-    user = interaction.user
-    if isinstance(user, discord.Member) and user.voice and user.voice.channel:
-        return user.voice.channel
+def get_user_voice_channel(member: Optional[discord.Member]) -> Optional[discord.VoiceChannel]:
+    """Return the member's current voice channel, or None."""
+    if member is not None and member.voice and member.voice.channel:
+        return member.voice.channel
     return None
 
 
 def bot_has_connect_speak(interaction: discord.Interaction, channel: discord.VoiceChannel) -> bool:
     """Check that the bot has Connect and Speak permissions in a given channel."""
     guild = interaction.guild
-    me = guild.get_member(bot.user.id) if (guild and bot.user) else None
+    me = guild.me if guild else None  # O(1) cached property, no member-cache lookup
     if not me:
         return False
     perms = channel.permissions_for(me)
     return perms.connect and perms.speak
 
 
+# Per-guild locks so concurrent /play//join don't race the voice handshake;
+# the second caller awaits the first and then hits the already-connected path.
+_connect_locks: dict[int, asyncio.Lock] = {}
+
+# Precompiled once; /play runs these on every query.
+URL_RE = re.compile(r"^https?://")
+YT_URL_RE = re.compile(r"^https?://(?:www\.|m\.|music\.)?(?:youtube\.com|youtu\.be)/")
+
+# Cap concurrent yt-dlp extractions so slow metadata fetches can't pile up
+# worker threads while the event loop keeps serving /ping and /queue.
+_ytdl_sem = asyncio.Semaphore(4)
+
+
 # -------------------------- Commands --------------------------
+_ping_cache: tuple[float, str] = (0.0, "")  # (monotonic ts, formatted reply)
+
+
 @tree.command(name="ping", description="Test at boten svarer raskt.")
 async def ping(interaction: discord.Interaction):
-    latency_ms = round(bot.latency * 1000)
-    await interaction.response.send_message(f"🏓 Pong! `{latency_ms} ms`", ephemeral=True)
+    # /ping doubles as a monitoring canary; reuse the formatted reply for 1s.
+    global _ping_cache
+    now = time.monotonic()
+    ts, msg = _ping_cache
+    if not msg or now - ts >= 1.0:
+        latency_ms = round(bot.latency * 1000)
+        msg = f"🏓 Pong! `{latency_ms} ms`"
+        _ping_cache = (now, msg)
+    await interaction.response.send_message(msg, ephemeral=True)
 
 
 @tree.command(name="join", description="Bli med i talekanalen din (uten å starte avspilling).")
+@app_commands.guild_only()
+@defer_first(ephemeral=True)
 async def join(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
-
-    await interaction.response.defer(ephemeral=True)
-
-    channel = await get_user_voice_channel(interaction)
+    guild = interaction.guild
+    user = interaction.user
+    member = user if isinstance(user, discord.Member) else None
+    channel = get_user_voice_channel(member)
     if not channel:
         await interaction.followup.send("❌ Du må være i en talekanal for å bruke denne kommandoen.", ephemeral=True)
         return
@@ -89,9 +149,11 @@ async def join(interaction: discord.Interaction):
         await interaction.followup.send("🚫 Jeg mangler **Connect**/**Speak** i denne talekanalen.", ephemeral=True)
         return
 
-    player = players.get_player(interaction.guild)
+    player = players.get_player(guild)
+    lock = _connect_locks.setdefault(guild.id, asyncio.Lock())
     try:
-        vc = await player.connect(channel)
+        async with lock:
+            vc = await player.connect(channel)
         await interaction.followup.send(f"🔊 Koblet til **{vc.channel.name}**.", ephemeral=True)
     except discord.errors.Forbidden:
         await interaction.followup.send("🚫 Mangler tillatelser i denne talekanalen (trenger **Connect** og **Speak**).", ephemeral=True)
@@ -102,15 +164,22 @@ async def join(interaction: discord.Interaction):
 
 
 @tree.command(name="play", description="Spill av en sang fra YouTube (lenke eller søk).")
+@app_commands.guild_only()
 @app_commands.describe(query="YouTube-lenke eller søk (f.eks. 'lofi hip hop')")
 @app_commands.checks.cooldown(2, 5.0)  # 2 uses per 5s per-user (mild anti-spam)
+@defer_first(thinking=True)
 async def play(interaction: discord.Interaction, query: str):
-    if not interaction.guild:
-        return
+    guild = interaction.guild
 
-    await interaction.response.defer(thinking=True)
+    # Reject non-YouTube links before spending a yt-dlp round-trip on them.
+    query = query.strip()
+    if not query or (URL_RE.match(query) and not YT_URL_RE.match(query)):
+        await interaction.followup.send("⚠️ Bare YouTube-lenker eller søketekst støttes.", ephemeral=True)
+        return
 
-    channel = await get_user_voice_channel(interaction)
+    user = interaction.user
+    member = user if isinstance(user, discord.Member) else None
+    channel = get_user_voice_channel(member)
     if not channel:
         await interaction.followup.send("❌ Du må være i en talekanall for å bruke denne kommandoen.", ephemeral=True)
         return
@@ -119,12 +188,14 @@ async def play(interaction: discord.Interaction, query: str):
         await interaction.followup.send("🚫 Jeg mangler **Connect**/**Speak** i denne talekanalen.", ephemeral=True)
         return
 
-    player = players.get_player(interaction.guild)
-    await player.connect(channel)
+    player = players.get_player(guild)
+    lock = _connect_locks.setdefault(guild.id, asyncio.Lock())
+    async with lock:
+        await player.connect(channel)
 
     try:
-        req_member = interaction.user if isinstance(interaction.user, discord.Member) else None
-        track = await Track.create(query, requester=req_member)
+        async with _ytdl_sem:
+            track = await Track.create(query, requester=member)
     except Exception as e:
         await interaction.followup.send(f"❌ Fikk ikke hentet lydkilde: `{e}`")
         return
@@ -138,49 +209,53 @@ async def play(interaction: discord.Interaction, query: str):
     )
     if track.duration:
         embed.add_field(name="Lengde", value=fmt_duration(track.duration), inline=True)
-    if isinstance(track.requester, discord.Member):
-        embed.set_footer(text=f"Ønsket av {track.requester.display_name}")
+    if member is not None:
+        embed.set_footer(text=f"Ønsket av {member.display_name}")
 
     await interaction.followup.send(embed=embed)
 
 
 @tree.command(name="queue", description="Se hva som spiller og køen videre.")
+@app_commands.guild_only()
 async def queue_cmd(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
+    guild = interaction.guild
 
-    player = players.get_player(interaction.guild)
+    player = players.get_player(guild)
     current = player.current
-    items = list(player.queue._queue)  # safe view; asyncio.Queue uses a deque internally
+    dq = player.queue  # plain deque; iterate it, don't copy
+    qlen = len(dq)
 
-    desc = ""
+    parts = []
     if current:
         dur = fmt_duration(current.duration) if current.duration else "live"
-        desc += f"**▶️ Spiller nå:** [{current.title}]({current.url}) — `{dur}`\n\n"
+        parts.append(f"**▶️ Spiller nå:** [{current.title}]({current.url}) — `{dur}`\n\n")
     else:
-        desc += "_Ingen sang spiller nå._\n\n"
-
-    if items:
-        lines = []
-        for i, t in enumerate(itertools.islice(items, 10), start=1):
-            d = fmt_duration(t.duration) if t.duration else "live"
-            lines.append(f"`{i:02d}.` [{t.title}]({t.url}) — `{d}`")
-        more = len(items) - 10
+        parts.append("_Ingen sang spiller nå._\n\n")
+
+    if qlen:
+        lines = [
+            f"`{i:02d}.` [{t.title}]({t.url}) — `{fmt_duration(t.duration) if t.duration else 'live'}`"
+            for i, t in zip(range(1, 11), dq)
+        ]
+        more = qlen - len(lines)
         if more > 0:
             lines.append(f"... og **{more}** til")
-        desc += "📜 **Kø:**\n" + "\n".join(lines)
+        parts.append("📜 **Kø:**\n" + "\n".join(lines))
     else:
-        desc += "📜 _Køen er tom._"
+        parts.append("📜 _Køen er tom._")
 
-    await interaction.response.send_message(embed=discord.Embed(description=desc, color=discord.Color.dark_blue()))
+    body = "".join(parts)
+    if len(body) > 4000:  # stay under Discord's 4096-char description limit
+        body = body[:3990] + "…"
+    await interaction.response.send_message(embed=discord.Embed(description=body, color=discord.Color.dark_blue()))
 
 
 @tree.command(name="skip", description="Hopp over nåværende sang.")
+@app_commands.guild_only()
 @app_commands.checks.cooldown(2, 5.0)
 async def skip(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
-    player = players.get_player(interaction.guild)
+    guild = interaction.guild
+    player = players.get_player(guild)
     if not player.current:
         await interaction.response.send_message("⚠️ Det spilles ingenting akkurat nå.", ephemeral=True)
         return
@@ -189,81 +264,85 @@ async def skip(interaction: discord.Interaction):
 
 
 @tree.command(name="stop", description="Stopp musikken og forlat talekanalen.")
+@app_commands.guild_only()
 async def stop(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
-    player = players.get_player(interaction.guild)
+    guild = interaction.guild
+    player = players.get_player(guild)
     await player.stop(disconnect=True)
     await interaction.response.send_message("⏹️ Stoppet og forlot talekanalen.")
 
 
 @tree.command(name="pause", description="Pause musikken.")
+@app_commands.guild_only()
 async def pause(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
-    player = players.get_player(interaction.guild)
+    guild = interaction.guild
+    player = players.get_player(guild)
     await player.pause()
     await interaction.response.send_message("⏸️ Pauset.")
 
 
 @tree.command(name="resume", description="Fortsett musikken etter pause.")
+@app_commands.guild_only()
 async def resume(interaction: discord.Interaction):
-    if not interaction.guild:
-        return
-    player = players.get_player(interaction.guild)
+    guild = interaction.guild
+    player = players.get_player(guild)
     await player.resume()
     await interaction.response.send_message("▶️ Fortsetter.")
 
 
 @tree.command(name="volume", description="Sett volum (0.0 til 1.5).")
+@app_commands.guild_only()
 async def volume(interaction: discord.Interaction, value: float):
-    if not interaction.guild:
-        return
+    guild = interaction.guild
     if value < 0 or value > 1.5:
         await interaction.response.send_message("⚠️ Volum må være mellom 0.0 og 1.5.", ephemeral=True)
         return
-    player = players.get_player(interaction.guild)
+    player = players.get_player(guild)
     await player.set_volume(value)
     await interaction.response.send_message(f"🔊 Volum satt til {value:.2f} (gjelder fra neste sang).")
 
 
 @tree.command(name="help", description="Vis en oversikt over alle kommandoene.")
 async def help_cmd(interaction: discord.Interaction):
-    embed = discord.Embed(
-        title="🤖 An29 BOT – Hjelp",
-        description="Her er en oversikt over kommandoene:",
-        color=discord.Color.blurple()
-    )
-    embed.add_field(name="▶️ /play <søk eller lenke>", value="Spill en sang fra YouTube.", inline=False)
-    embed.add_field(name="📜 /queue", value="Se hva som spilles nå og resten av køen.", inline=False)
-    embed.add_field(name="⏭️ /skip", value="Hopp over sangen.", inline=False)
-    embed.add_field(name="⏹️ /stop", value="Stopp musikken og koble fra voice.", inline=False)
-    embed.add_field(name="⏸️ /pause", value="Pause avspillingen.", inline=False)
-    embed.add_field(name="▶️ /resume", value="Fortsett etter pause.", inline=False)
-    embed.add_field(name="🔊 /volume <0.0–1.5>", value="Juster volumet (gjelder fra neste sang).", inline=False)
-    embed.add_field(name="🔗 /join", value="Koble boten til voicechannel.", inline=False)
-    embed.add_field(name="🏓 /ping", value="Test responstid (Pong!).", inline=False)
-    embed.add_field(name="ℹ️ /help", value="Viser denne oversikten.", inline=False)
-
-    if bot.user and bot.user.avatar:
-        embed.set_thumbnail(url=bot.user.avatar.url)
-        embed.set_footer(text="@anthonyleinebo – meld features/bugs 😎")
-    else:
-        embed.set_footer(text="@anthonyleinebo – meld features/bugs 😎")
-
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    # Embeds are serialized per-send, so reusing the shared instance is safe.
+    await interaction.response.send_message(embed=HELP_EMBED_BASE, ephemeral=True)
 
 
 # -------------------------- Event hooks --------------------------
+CMDSPEC_FILE = ".cmdspec"  # hash of the last synced command spec
+
+
+def _command_spec_hash() -> str:
+    """Stable hash of the local app-command definitions."""
+    spec = json.dumps([c.to_dict(tree) for c in tree.get_commands()], sort_keys=True)
+    return hashlib.blake2b(spec.encode()).hexdigest()
+
+
 @bot.event
 async def on_ready():
+    # tree.sync() is a global HTTP round-trip that counts against Discord's
+    # daily rate limit; skip it on reconnects when the spec hasn't changed.
     try:
-        await tree.sync()
-        print(f"Synced {len(tree.get_commands())} app commands.")
-    except Exception as e:
-        print("Kunne ikke sync'e slash-commands:", e)
+        spec_hash = _command_spec_hash()
+        try:
+            with open(CMDSPEC_FILE) as f:
+                synced = f.read().strip() == spec_hash
+        except OSError:
+            synced = False
+
+        if synced:
+            log.info("App commands uendret (%d) – hopper over sync.", len(tree.get_commands()))
+        else:
+            await tree.sync()
+            with open(CMDSPEC_FILE, "w") as f:
+                f.write(spec_hash)
+            log.info("Synced %d app commands.", len(tree.get_commands()))
+    except Exception:
+        log.exception("Kunne ikke sync'e slash-commands")
     if bot.user:
-        print(f"Logget inn som {bot.user} (ID: {bot.user.id})")
+        if bot.user.avatar:
+            HELP_EMBED_BASE.set_thumbnail(url=bot.user.avatar.url)
+        log.info("Logget inn som %s (ID: %s)", bot.user, bot.user.id)
 
 
 @bot.tree.error
@@ -287,13 +366,23 @@ async def on_app_command_error(interaction: discord.Interaction, error: Exceptio
             await interaction.response.send_message(msg, ephemeral=True)
     except Exception:
         pass  # swallow to avoid secondary exceptions in error path
-    import traceback
-    traceback.print_exception(error)
+    log.exception("app command error", exc_info=error)
 
 
 # -------------------------- Main --------------------------
 if __name__ == "__main__":
+    # .env/token loading only matters when actually running the bot;
+    # importing this module (tests, tooling) skips it.
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    TOKEN = os.getenv("DISCORD_TOKEN")
     if not TOKEN:
         raise SystemExit("❌ Manglende DISCORD_TOKEN i .env")
+    try:
+        import uvloop  # 2-4x lower event-loop overhead on Linux
+        uvloop.install()
+    except ImportError:
+        pass
     # Discord.py handles loop lifecycle internally
     bot.run(TOKEN, log_handler=None)
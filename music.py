@@ -4,14 +4,19 @@ Music subsystem: queue, track extraction (yt-dlp), and voice playback.
 
 - Extracts best Opus/PCM streams via yt-dlp.
 - Prefers Opus with a bitrate cap based on channel bitrate; falls back to PCM.
-- Provides a per-guild MusicPlayer with an asyncio queue and an idle disconnect.
+- Provides a per-guild MusicPlayer with a deque-backed queue and an idle disconnect.
 """
 
 from __future__ import annotations
 
 import asyncio
+import functools
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Sequence
 
 import discord
 from discord import VoiceClient
@@ -24,18 +29,68 @@ YTDL_OPTS = {
     "default_search": "ytsearch",
     "noplaylist": True,
     "source_address": "0.0.0.0",
-    "extract_flat": False,
+    # Flat stubs for search/playlist hits: only the chosen entry gets a full
+    # (JS-challenge) extraction instead of every returned hit.
+    "extract_flat": "in_playlist",
     "nocheckcertificate": True,  # reduces SSL fuss on some hosts/networks
+    # yt-dlp falls back across clients internally, so SABR/PO-token-gated
+    # videos resolve in a single extract_info call instead of two round-trips.
+    "extractor_args": {"youtube": {"player_client": ["web", "ios", "tv"]}},
 }
 _ytdl = YoutubeDL(YTDL_OPTS)
 
+# Dedicated executor for yt-dlp: extractions can hold a thread for 10-30 s,
+# so keep them off the loop's shared default pool and cap their concurrency.
+_YTDL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ytdl")
 
-def ffmpeg_volume_filter(vol: float) -> str:
-    """Return an FFmpeg volume filter for 0.0–1.5 (empty if ~1.0)."""
-    v = max(0.0, min(1.5, vol))
+
+def shutdown_ytdl_pool() -> None:
+    """Tear down the yt-dlp executor (e.g. on bot shutdown/cog unload)."""
+    _YTDL_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+# Short-lived cache of resolved extractions: re-enqueueing the same URL/query
+# within the TTL skips the slow yt-dlp round-trip entirely. TTL stays well
+# under YouTube's ~6h signed-URL lifetime so cached stream URLs remain valid.
+_EXTRACT_TTL = 300  # seconds
+_EXTRACT_CACHE: dict[str, tuple[float, dict]] = {}
+_EXTRACT_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def _extract_cache_key(query: str) -> str:
+    """Normalize a query into a cache key (strip fragments, lowercase searches)."""
+    q = query.strip()
+    if q.startswith(("http://", "https://")):
+        return q.split("#", 1)[0]
+    return q.lower()
+
+
+def _purge_extract_cache() -> None:
+    """Opportunistically drop expired entries once the cache grows past 256 keys."""
+    if len(_EXTRACT_CACHE) <= 256:
+        return
+    now = time.monotonic()
+    for k in [k for k, (ts, _) in _EXTRACT_CACHE.items() if now - ts >= _EXTRACT_TTL]:
+        _EXTRACT_CACHE.pop(k, None)
+        lock = _EXTRACT_LOCKS.get(k)
+        if lock is not None and not lock.locked():
+            _EXTRACT_LOCKS.pop(k, None)
+
+
+@functools.lru_cache(maxsize=64)
+def _volume_filter_cached(v: float) -> str:
     return f'-filter:a "volume={v}"' if abs(v - 1.0) > 1e-3 else ""
 
 
+def ffmpeg_volume_filter(vol: float) -> str:
+    """Return an FFmpeg volume filter for 0.0–1.5 (empty if ~1.0).
+
+    Users pick from a handful of volume values, so the formatted filter is
+    memoized; input is clamped and rounded for stable float cache keys.
+    """
+    return _volume_filter_cached(round(max(0.0, min(1.5, vol)), 3))
+
+
 @dataclass
 class Track:
     """Represents a playable audio track."""
@@ -44,42 +99,49 @@ class Track:
     stream_url: str     # Direct media URL for FFmpeg
     duration: Optional[int] = None
     requester: Optional[discord.Member] = None
+    is_opus: bool = False  # upstream is already Opus (webm), eligible for remux
 
     @classmethod
     async def create(cls, query: str, requester: Optional[discord.Member] = None) -> "Track":
         """
         Resolve a query (URL or search) to a playable stream with yt-dlp.
-        Falls back to alternate YouTube clients if SABR/PO tokens get in the way.
+        Alternate YouTube clients (ios/tv) are tried inside the single
+        extract_info call if SABR/PO tokens get in the way.
         """
         loop = asyncio.get_running_loop()
 
-        def _extract(q, opts=None):
-            if opts is None:
-                return _ytdl.extract_info(q, download=False)
-            with YoutubeDL({**YTDL_OPTS, **opts}) as alt:
-                return alt.extract_info(q, download=False)
-
-        data = await loop.run_in_executor(None, lambda: _extract(query))
-
-        if "entries" in data:
-            # search result or playlist entry: pick the first valid hit
-            data = next((e for e in data["entries"] if e), None)
-            if data is None:
-                raise RuntimeError("Fant ingen treff.")
-
-        stream = data.get("url")
-
-        # Fallback: try alternate player clients (ios/tv) in case of token issues
-        if not stream:
-            alt_opts = {"extractor_args": {"youtube": {"player_client": ["ios", "tv"]}}}
-            data = await loop.run_in_executor(None, lambda: _extract(query, alt_opts))
-            if "entries" in data:
-                data = next((e for e in data["entries"] if e), None)
-                if data is None:
-                    raise RuntimeError("Fant ingen treff (fallback).")
-            stream = data.get("url")
-            if not stream:
-                raise RuntimeError("Kunne ikke hente direkte lyd-URL (SABR/PO-token).")
+        def _extract(q):
+            return _ytdl.extract_info(q, download=False)
+
+        key = _extract_cache_key(query)
+        # Per-key lock: two simultaneous plays of the same query only hit
+        # yt-dlp once; the second awaiter reads the cache.
+        lock = _EXTRACT_LOCKS.setdefault(key, asyncio.Lock())
+        async with lock:
+            hit = _EXTRACT_CACHE.get(key)
+            if hit is not None and time.monotonic() - hit[0] < _EXTRACT_TTL:
+                data = hit[1]
+            else:
+                data = await loop.run_in_executor(_YTDL_POOL, _extract, query)
+
+                if "entries" in data:
+                    # search result or playlist entry: pick the first valid hit;
+                    # the flat stub lacks a stream URL, so resolve it fully now
+                    data = next((e for e in data["entries"] if e), None)
+                    if data is None:
+                        raise RuntimeError("Fant ingen treff.")
+                    if not data.get("url") or not data.get("acodec"):
+                        target = data.get("webpage_url") or data.get("url")
+                        if target:
+                            data = await loop.run_in_executor(_YTDL_POOL, _extract, target)
+
+                if not data.get("url"):
+                    raise RuntimeError("Kunne ikke hente direkte lyd-URL (SABR/PO-token).")
+
+                _EXTRACT_CACHE[key] = (time.monotonic(), data)
+                _purge_extract_cache()
+
+        stream = data["url"]
 
         return cls(
             title=data.get("title", "Ukjent tittel"),
@@ -87,45 +149,83 @@ class Track:
             stream_url=stream,
             duration=int(data["duration"]) if data.get("duration") else None,
             requester=requester,
+            is_opus=data.get("acodec") == "opus" and data.get("ext") == "webm",
         )
 
+    async def refresh(self) -> None:
+        """Re-resolve this track's stream URL in place (cheap on cache hits).
+
+        Used by the player's lookahead so the head of the queue has a fresh
+        stream URL by the time playback reaches it.
+        """
+        fresh = await Track.create(self.url, requester=self.requester)
+        self.title = fresh.title
+        self.stream_url = fresh.stream_url
+        self.duration = fresh.duration
+        self.is_opus = fresh.is_opus
+
 
 class MusicPlayer:
     """
     Per-guild music player with:
-    - asyncio.Queue for tracks
+    - deque of tracks + an "item available" Event (single consumer, O(1) peek/drain)
     - single playback task
     - idle disconnect timer
     """
     def __init__(self, guild: discord.Guild):
         self.guild = guild
-        self.queue: asyncio.Queue[Track] = asyncio.Queue()
+        self.queue: deque[Track] = deque()
+        self._has_item = asyncio.Event()
         self.next_event = asyncio.Event()
         self.current: Optional[Track] = None
         self.player_task: Optional[asyncio.Task] = None
+        self._prefetch_task: Optional[asyncio.Task] = None
+        self._skip_waiter: Optional[asyncio.Task] = None  # long-lived next_event waiter
+        self._pool: Optional[weakref.ref] = None  # set by PlayerPool.get_player
 
         # defaults
         self.volume = 0.35
         self.idle_disconnect_after = 900  # seconds
+        self._target_kbps = 128  # recomputed on connect from channel bitrate
+        self._refresh_opus_options()  # precomputed FFmpeg options for the current volume
 
     # ---- Public API used by bot.py ----
     async def enqueue(self, track: Track):
-        await self.queue.put(track)
+        self.queue.append(track)
+        self._has_item.set()
         print(f"🎵 Enqueued: {track.title}")
         self.ensure_task()
 
+    async def enqueue_many(self, tracks: Sequence[Track]):
+        """Enqueue a batch (e.g. a playlist) with a single wakeup signal
+        instead of N individual enqueue round-trips."""
+        if not tracks:
+            return
+        self.queue.extend(tracks)
+        self._has_item.set()
+        print(f"🎵 Enqueued {len(tracks)} tracks")
+        self.ensure_task()
+
+    def peek(self) -> Optional[Track]:
+        """Next track without removing it, or None if the queue is empty."""
+        return self.queue[0] if self.queue else None
+
     async def skip(self):
+        self._cancel_prefetch()
         vc = self._voice
-        if vc and vc.is_playing():
-            vc.stop()
+        if vc:
+            # stop() is an idempotent no-op when nothing plays; skipping the
+            # is_playing() probe avoids redundant lock acquisitions.
+            try:
+                vc.stop()
+            except Exception:
+                pass
         self.next_event.set()
 
     async def stop(self, disconnect: bool = True):
-        while not self.queue.empty():
-            try:
-                self.queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
+        self._cancel_prefetch()
+        self.queue.clear()
+        self._has_item.clear()
         self.next_event.set()
 
         vc = self._voice
@@ -147,11 +247,41 @@ class MusicPlayer:
     async def set_volume(self, vol: float):
         """Set logical volume in [0.0, 1.5]. Opus path uses FFmpeg filter, PCM path uses transformer."""
         self.volume = max(0.0, min(1.5, vol))
+        self._refresh_opus_options()
+
+    def _refresh_opus_options(self):
+        """Rebuild the cached FFmpeg options string; volume changes are rare,
+        so the per-track hot path just reads the precomputed value."""
+        vf = ffmpeg_volume_filter(self.volume)
+        self._opus_options = f"-vn -ac 2 -ar 48000 -threads 1 -loglevel warning {vf}".strip()
+        self._needs_reencode = bool(vf)  # a volume filter forces decode+re-encode
 
     def ensure_task(self):
         if self.player_task is None or self.player_task.done():
             self.player_task = asyncio.create_task(self._player_loop(), name=f"player-{self.guild.id}")
 
+    # ---- Lookahead: refresh the next track while the current one plays ----
+    def _start_prefetch(self):
+        if self._prefetch_task is None or self._prefetch_task.done():
+            self._prefetch_task = asyncio.create_task(self._prefetch_head())
+
+    def _cancel_prefetch(self):
+        if self._prefetch_task and not self._prefetch_task.done():
+            self._prefetch_task.cancel()
+        self._prefetch_task = None
+
+    async def _prefetch_head(self):
+        """Overlap the next track's extraction with current playback."""
+        nxt = self.peek()
+        if nxt is None:
+            return
+        try:
+            await nxt.refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[player] Prefetch feilet (ignoreres): {e}")
+
     # ---- Voice helpers ----
     @property
     def _voice(self) -> Optional[VoiceClient]:
@@ -171,19 +301,38 @@ class MusicPlayer:
         else:
             vc = await channel.connect(self_deaf=True, timeout=10, reconnect=False)
 
-        # wait briefly for the state to settle (voice handshake)
-        for _ in range(15):  # ~3 seconds total
-            await asyncio.sleep(0.2)
-            if vc.is_connected():
-                break
+        # channel.connect() awaits the handshake itself; this is a short
+        # backoff-based safety net for the rare unsettled state, instead of
+        # the old fixed 15 x 200 ms poll.
+        if not vc.is_connected():
+            try:
+                await asyncio.wait_for(self._wait_connected(vc), timeout=3.0)
+            except asyncio.TimeoutError:
+                pass
 
         if not vc or not vc.is_connected():
             raise RuntimeError("Voice handshake failed (mulig brannmur/UDP blokkerer).")
 
+        # Channel bitrate only changes with the channel, not per track; cache
+        # the Opus bitrate cap here instead of recomputing in the player loop.
+        bps = getattr(channel, "bitrate", 128_000) or 128_000
+        cap = max(64, min(256, bps // 1000))
+        self._target_kbps = 192 if cap >= 192 else cap
+
         return vc
 
+    @staticmethod
+    async def _wait_connected(vc: VoiceClient) -> None:
+        """Poll vc.is_connected() with exponential backoff (50 ms start)."""
+        delay = 0.05
+        while not vc.is_connected():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.4)
+
     # ---- Core playback loop ----
     async def _player_loop(self):
+        loop = asyncio.get_running_loop()
+
         # ensure we are self-deaf to reduce echo/noise
         if self._voice:
             try:
@@ -195,25 +344,35 @@ class MusicPlayer:
             except Exception:
                 pass
 
-        idle_timer: Optional[asyncio.Task] = None
+        # TimerHandles are far cheaper to schedule/cancel than Tasks, and we
+        # churn the idle timer on every queue transition.
+        idle_handle: Optional[asyncio.TimerHandle] = None
 
         def start_idle_timer():
-            nonlocal idle_timer
-            if idle_timer and not idle_timer.done():
-                return
-            idle_timer = asyncio.create_task(self._idle_disconnect_task())
+            nonlocal idle_handle
+            if idle_handle is not None and idle_handle.when() > loop.time():
+                return  # still pending
+            idle_handle = loop.call_later(
+                self.idle_disconnect_after,
+                lambda: asyncio.create_task(self._do_idle_disconnect()),
+            )
 
         def cancel_idle_timer():
-            nonlocal idle_timer
-            if idle_timer and not idle_timer.done():
-                idle_timer.cancel()
-                idle_timer = None
+            nonlocal idle_handle
+            if idle_handle is not None:
+                idle_handle.cancel()
+                idle_handle = None
 
         start_idle_timer()
 
         while True:
             self.next_event.clear()
-            self.current = await self.queue.get()
+            while not self.queue:
+                self._has_item.clear()
+                await self._has_item.wait()
+            self.current = self.queue.popleft()
+            if not self.queue:
+                self._has_item.clear()
             cancel_idle_timer()
 
             vc = self._voice
@@ -227,23 +386,34 @@ class MusicPlayer:
             def after_play(err: Optional[Exception]):
                 if err:
                     print(f"[player] FFmpeg error: {err}")
-                done_event.set()
+                # Runs on discord.py's voice thread; Event.set() isn't
+                # thread-safe, so schedule it onto the loop to guarantee the
+                # waiter actually wakes up.
+                loop.call_soon_threadsafe(done_event.set)
 
-            # Choose a target Opus bitrate capped by channel bitrate
-            channel_bps = getattr(vc.channel, "bitrate", 128_000) or 128_000
-            cap_kbps = max(64, min(256, channel_bps // 1000))
-            target_kbps = 192 if cap_kbps >= 192 else cap_kbps
+            target_kbps = self._target_kbps  # cached per-connect from channel bitrate
 
             async def start_opus() -> bool:
                 try:
-                    vol_filter = ffmpeg_volume_filter(self.volume)
-                    src = discord.FFmpegOpusAudio(
-                        self.current.stream_url,
-                        bitrate=target_kbps,
-                        before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                        options=f"-vn -ac 2 -ar 48000 -loglevel warning {vol_filter}".strip()
-                    )
-                    print(f"▶️ Spiller nå (Opus {target_kbps}k): {self.current.title}")
+                    if self.current.is_opus and not self._needs_reencode:
+                        # Source is already Opus and no volume filter needed:
+                        # remux (-c:a copy) instead of decode+re-encode.
+                        src = discord.FFmpegOpusAudio(
+                            self.current.stream_url,
+                            codec="copy",
+                            bitrate=None,
+                            before_options="-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+                            options="-vn -loglevel warning"
+                        )
+                        print(f"▶️ Spiller nå (Opus remux): {self.current.title}")
+                    else:
+                        src = discord.FFmpegOpusAudio(
+                            self.current.stream_url,
+                            bitrate=target_kbps,
+                            before_options="-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+                            options=self._opus_options
+                        )
+                        print(f"▶️ Spiller nå (Opus {target_kbps}k): {self.current.title}")
                     vc.play(src, after=after_play)
                     return True
                 except Exception as e:
@@ -254,8 +424,8 @@ class MusicPlayer:
                 try:
                     pcm = discord.FFmpegPCMAudio(
                         self.current.stream_url,
-                        before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                        options="-vn -ac 2 -ar 48000 -loglevel warning"
+                        before_options="-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+                        options="-vn -ac 2 -ar 48000 -threads 1 -loglevel warning"
                     )
                     src = discord.PCMVolumeTransformer(pcm, volume=float(min(self.volume, 1.0)))
                     print(f"▶️ Spiller nå (PCM fallback): {self.current.title}")
@@ -265,35 +435,63 @@ class MusicPlayer:
                     print(f"[player] PCM-start feilet: {e}")
                     return False
 
-            if not await start_opus():
-                if not await start_pcm():
-                    print("[player] Ingen avspilling lyktes.")
-                    self.current = None
-                    start_idle_timer()
-                    continue
-
-            # Give FFmpeg/voice pipeline a moment to start
-            await asyncio.sleep(2.0)
-            if not vc.is_playing():
-                print("[player] Opus stoppet for tidlig / ikke i gang → bytter til PCM.")
-                if vc.is_playing() or vc.is_paused():
-                    vc.stop()
-                if not await start_pcm():
-                    print("[player] PCM fallback feilet.")
-                    self.current = None
-                    start_idle_timer()
-                    continue
+            # Pick the start path once from the extracted codec: non-Opus
+            # sources go straight to PCM instead of paying a doomed FFmpeg
+            # spawn + HTTPS setup on the Opus path first.
+            on_opus = False
+            if self.current.is_opus:
+                on_opus = await start_opus()
+                ok = on_opus or await start_pcm()
+            else:
+                ok = await start_pcm()
+            if not ok:
+                print("[player] Ingen avspilling lyktes.")
+                self.current = None
+                start_idle_timer()
+                continue
 
-            # Wait for either playback end or a skip request
+            if on_opus:
+                # Safety net for the Opus path only. VoiceClient.play() raises
+                # synchronously if FFmpeg fails to spawn, so the only failure
+                # left is "spawned but died at once" — and after_play signals
+                # done_event within milliseconds when that happens. Wait on
+                # that signal briefly instead of sleeping out a fixed probe.
+                try:
+                    await asyncio.wait_for(done_event.wait(), timeout=0.3)
+                    fallback_needed = True
+                except asyncio.TimeoutError:
+                    fallback_needed = False
+                if fallback_needed:
+                    print("[player] Opus stoppet for tidlig / ikke i gang → bytter til PCM.")
+                    try:
+                        vc.stop()
+                    except Exception:
+                        pass
+                    done_event.clear()  # may have been set by the failed Opus attempt
+                    if not await start_pcm():
+                        print("[player] PCM fallback feilet.")
+                        self.current = None
+                        start_idle_timer()
+                        continue
+
+            # Audio is flowing: refresh the next track in the background so
+            # the song transition doesn't wait on extraction.
+            self._start_prefetch()
+
+            # Wait for either playback end or a skip request. The skip waiter
+            # survives across tracks (recreated only after it fires); only the
+            # done waiter is a per-track allocation.
+            if self._skip_waiter is None or self._skip_waiter.done():
+                self._skip_waiter = asyncio.create_task(self.next_event.wait())
             done_waiter = asyncio.create_task(done_event.wait())
-            skip_waiter = asyncio.create_task(self.next_event.wait())
-            done, pending = await asyncio.wait({done_waiter, skip_waiter}, return_when=asyncio.FIRST_COMPLETED)
-            for p in pending:
-                p.cancel()
+            done, _ = await asyncio.wait({done_waiter, self._skip_waiter}, return_when=asyncio.FIRST_COMPLETED)
 
-            if skip_waiter in done:
-                if vc.is_playing() or vc.is_paused():
+            if self._skip_waiter in done:
+                done_waiter.cancel()
+                try:
                     vc.stop()
+                except Exception:
+                    pass
                 print("⏭️ Skippet sangen.")
             else:
                 print("✅ Ferdig med sangen.")
@@ -301,22 +499,37 @@ class MusicPlayer:
             self.current = None
             start_idle_timer()
 
-    async def _idle_disconnect_task(self):
-        """Disconnect from voice after a long idle period."""
-        try:
-            await asyncio.sleep(self.idle_disconnect_after)
-            if not self.current and self.queue.empty():
-                vc = self._voice
-                if vc and vc.is_connected():
-                    print("💤 Idle lenge – kobler fra VC.")
-                    await vc.disconnect(force=True)
-        except asyncio.CancelledError:
-            pass
+    async def _do_idle_disconnect(self):
+        """Disconnect from voice if still idle when the idle timer fires."""
+        if not self.current and not self.queue:
+            vc = self._voice
+            if vc and vc.is_connected():
+                print("💤 Idle lenge – kobler fra VC.")
+                await vc.disconnect(force=True)
+            self._on_disposed()
+
+    def _on_disposed(self):
+        """Release this player after an idle disconnect.
+
+        Cancels the playback task and drops the pool entry so memory stays
+        bounded by active guilds instead of every guild that ever played.
+        A later command simply gets a fresh player from the pool.
+        """
+        self._cancel_prefetch()
+        if self._skip_waiter and not self._skip_waiter.done():
+            self._skip_waiter.cancel()
+        if self.player_task and not self.player_task.done():
+            self.player_task.cancel()
+        pool = self._pool() if self._pool is not None else None
+        if pool is not None:
+            pool.pop(self.guild.id, None)
 
 
 class PlayerPool(dict[int, MusicPlayer]):
     """Simple registry for per-guild MusicPlayer instances."""
     def get_player(self, guild: discord.Guild) -> MusicPlayer:
         if guild.id not in self:
-            self[guild.id] = MusicPlayer(guild)
+            player = MusicPlayer(guild)
+            player._pool = weakref.ref(self)  # lets idle disposal evict itself
+            self[guild.id] = player
         return self[guild.id]